@@ -0,0 +1,567 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import types
+import ctypes
+import random
+import struct
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+from contextlib import redirect_stdout
+
+from dta_server import NUM_TYPES
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# A run is flagged as a regression when its fastest time is more than
+# this many times the fastest time of the baseline run, and slower by
+# more than the floor, in seconds. The fastest of several runs varies
+# much less between runs than the median does, and the floor keeps
+# sub-millisecond jitter from being flagged.
+DEFAULT_THRESHOLD = 1.25
+DEFAULT_FLOOR = 0.001
+
+# meta entries that must match for two runs to be compared
+WORKLOAD_KEYS = ("rows", "cols", "missing", "seed", "repeat", "bridge_repeat")
+
+# units attached to synthetic numeric variables, and what to convert to
+UNITS_CYCLE = (("mi", "km"), ("lb", "kg"), ("gallon", "liter"),
+               ("hour", "minute"), ("m", "ft"))
+
+UNIT_STRS = ("m", "km", "mi/hour", "m/s^2", "lb*ft^2", "kg/m^3",
+             "mpg", "L_per_100km", "dozen", "gallon/mi")
+
+
+#-------------------------------------------------------------------------
+# synthetic data
+#-------------------------------------------------------------------------
+
+def make_dta117(address, nobs, nvar, missing=0.0, seed=0):
+    """Write a version 117 dta file of nobs rows and nvar numeric
+    variables, plus a positive weight variable `w` and a str8 variable
+    `id`. Numeric variables cycle through double, float, long, int,
+    and byte types, have `_units` characteristics, and have roughly
+    the given fraction of missing values ('.' and '.a' - '.c').
+
+    """
+    rng = random.Random(seed)
+    bo = '<'
+
+    num_types = (65526, 65527, 65528, 65529, 65530)
+    varlist = ["x{}".format(i) for i in range(nvar)] + ["w", "id"]
+    typlist = [num_types[i % 5] for i in range(nvar)] + [65526, 8]
+    chrdict = {"x{}".format(i): {"_units": UNITS_CYCLE[i % 5][0]}
+               for i in range(nvar)}
+    nvar_all = len(varlist)
+
+    def section(tag, body):
+        return b''.join((b'<', tag, b'>', body, b'</', tag, b'>'))
+
+    def fixed(strs, width):
+        return b''.join(s.encode('iso-8859-1')[:width - 1].ljust(width, b'\0')
+                        for s in strs)
+
+    header = b''.join((
+        b'<header><release>117</release><byteorder>LSF</byteorder>',
+        b'<K>', struct.pack(bo + 'H', nvar_all), b'</K>',
+        b'<N>', struct.pack(bo + 'I', nobs), b'</N>',
+        b'<label>', bytes([14]), b'synthetic data', b'</label>',
+        b'<timestamp>', bytes([17]), b' 1 Jan 2014 00:00', b'</timestamp>',
+        b'</header>'
+    ))
+
+    chrs = [b'<characteristics>']
+    for varname, var_chrs in chrdict.items():
+        for charname, contents in var_chrs.items():
+            contents = contents.encode('iso-8859-1') + b'\0'
+            chrs.extend((b'<ch>', struct.pack(bo + 'I', 66 + len(contents)),
+                         fixed([varname], 33), fixed([charname], 33),
+                         contents, b'</ch>'))
+    chrs.append(b'</characteristics>')
+
+    # sections before the data, with a placeholder map
+    pre_map = b'<stata_dta>' + header
+    sections = [
+        section(b'variable_types',
+                struct.pack(bo + str(nvar_all) + 'H', *typlist)),
+        section(b'varnames', fixed(varlist, 33)),
+        section(b'sortlist', b'\0' * 2 * (nvar_all + 1)),
+        section(b'formats', fixed(["%9.0g"] * (nvar_all - 1) + ["%8s"], 49)),
+        section(b'value_label_names', b'\0' * 33 * nvar_all),
+        section(b'variable_labels',
+                fixed(["variable " + name for name in varlist], 81)),
+        b''.join(chrs),
+    ]
+
+    offsets = [0, len(pre_map)]
+    pos = len(pre_map) + 5 + 112 + 6
+    for sec in sections:
+        offsets.append(pos)
+        pos += len(sec)
+    offsets.append(pos)  # <data>
+
+    packers = [struct.Struct(bo + NUM_TYPES[t][1]) if t in NUM_TYPES else None
+               for t in typlist]
+
+    def num_value(typ):
+        size, code, miss_min = NUM_TYPES[typ]
+        if rng.random() < missing:
+            mv_index = rng.choice((0, 0, 0, 1, 2, 3))
+            if code == 'f':
+                return struct.pack(bo + 'I', miss_min + (mv_index << 11))
+            if code == 'd':
+                return struct.pack(bo + 'Q', miss_min + (mv_index << 40))
+            return struct.pack(bo + code, miss_min + mv_index)
+        if code in 'fd':
+            return struct.pack(bo + code, rng.gauss(50, 15))
+        return struct.pack(bo + code, rng.randint(-100, 100))
+
+    with open(address, 'wb') as dta_file:
+        dta_file.write(pre_map)
+        map_pos = dta_file.tell()
+        dta_file.write(b'<map>' + b'\0' * 112 + b'</map>')
+        for sec in sections:
+            dta_file.write(sec)
+        dta_file.write(b'<data>')
+        for i in range(nobs):
+            row = [num_value(typlist[j]) for j in range(nvar)]
+            row.append(packers[nvar].pack(rng.uniform(0.5, 2.0)))
+            row.append("id{}".format(i).encode()[:8].ljust(8, b'\0'))
+            dta_file.write(b''.join(row))
+        dta_file.write(b'</data>')
+        offsets.append(dta_file.tell())
+        dta_file.write(b'<strls></strls>')
+        offsets.append(dta_file.tell())
+        dta_file.write(b'<value_labels></value_labels>')
+        offsets.append(dta_file.tell())
+        dta_file.write(b'</stata_dta>')
+        offsets.append(dta_file.tell())
+        dta_file.seek(map_pos + 5)
+        dta_file.write(struct.pack(bo + '14Q', *offsets))
+
+
+#-------------------------------------------------------------------------
+# timing
+#-------------------------------------------------------------------------
+
+def time_it(func, repeat, setup=None):
+    """return timing summary of repeat calls of func, in seconds;
+    setup, if given, is called (untimed) before each call
+
+    """
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'runs': len(times),
+        'threshold': DEFAULT_THRESHOLD,
+        'floor': DEFAULT_FLOOR,
+    }
+
+
+def bench_units(address, repeat):
+    """time units parsing, conversion, and summarize on UDta"""
+    from units_dta import UDta
+
+    with redirect_stdout(io.StringIO()):
+        dta = UDta(address)
+    varlist = dta._varlist
+    numvars = [v for v in varlist if v.startswith("x")]
+    indexes = [varlist.index(v) for v in numvars]
+    wt_index = varlist.index("w")
+    obs = list(range(len(dta._varvals)))
+
+    def parse():
+        for unit_str in UNIT_STRS:
+            dta._get_unit(unit_str)
+
+    def convert():
+        for i, varname in enumerate(numvars):
+            old, new = UNITS_CYCLE[i % len(UNITS_CYCLE)]
+            dta.units_convert(varname, new)
+            dta.units_convert(varname, old)
+
+    return {
+        'units_parse': time_it(parse, repeat),
+        'units_convert': time_it(convert, repeat),
+        'summ_default': time_it(
+            lambda: dta._summ_default(None, None, obs, numvars, indexes, 5),
+            repeat),
+        'summ_default_weighted': time_it(
+            lambda: dta._summ_default(wt_index, 'a', obs, numvars, indexes, 5),
+            repeat),
+        'summ_detail': time_it(
+            lambda: dta._summ_detail(None, None, obs, numvars, indexes),
+            repeat),
+        'summ_detail_weighted': time_it(
+            lambda: dta._summ_detail(wt_index, 'a', obs, numvars, indexes),
+            repeat),
+    }
+
+
+#-------------------------------------------------------------------------
+# notebook bridge with a scripted fake Stata
+#-------------------------------------------------------------------------
+
+# scripted output for commands sent to the fake Stata, by first word
+FAKE_OUTPUT = {
+    "summarize": "\n".join(
+        ["", "    Variable |       Obs        Mean    Std. Dev.       Min        Max",
+         "-------------+--------------------------------------------------------"] +
+        ["{:>12} |      1000    50.12345    15.12345   3.45678   97.65432".format(
+            "x{}".format(i)) for i in range(20)]),
+}
+
+# smallest valid-looking png file, for graph export
+FAKE_PNG = b'\x89PNG\r\n\x1a\n' + b'\0' * 64
+
+
+class FakeStata():
+    """Stand-in for the Stata automation object. Commands are echoed to
+    the log file as Stata would, followed by scripted output.
+
+    Commands whose cost grows with the data take time in proportion to
+    nobs and nvar (see `cost`), so that timings show what the output
+    cache costs and saves, not only the overhead of the output path.
+
+    """
+    # Rough guesses at Stata's speed, not measurements: seconds per
+    # value (nobs * nvar) or per observation, and seconds per graph
+    # export. Commands not listed take no time.
+    SECONDS_PER_VALUE = {"datasignature": 2e-8, "summarize": 2e-8}
+    SECONDS_PER_OBS = {"scatter": 2e-6}
+    GRAPH_EXPORT_SECONDS = 0.01
+
+    def __init__(self, nobs=10000, nvar=20):
+        self.log_address = None
+        self.r_file = None
+        self.nobs = nobs
+        self.nvar = nvar
+
+    def cost(self, cmd):
+        """return seconds the command would take"""
+        words = cmd.split()
+        if words[0] in ("capture", "quietly") and len(words) > 1:
+            words = words[1:]
+        if words[0] == "graph" and words[1:2] == ["export"]:
+            return self.GRAPH_EXPORT_SECONDS
+        return (self.SECONDS_PER_VALUE.get(words[0], 0) * self.nobs * self.nvar
+                + self.SECONDS_PER_OBS.get(words[0], 0) * self.nobs)
+
+    def _log(self, text):
+        if self.log_address is not None:
+            with open(self.log_address, 'a') as log:
+                log.write(text)
+
+    def DoCommandAsync(self, cmd):
+        cmd = cmd.strip()
+        m = re.match(r'log using (.+?)\s*,', cmd)
+        if m:
+            self.log_address = m.group(1).strip('"')
+            open(self.log_address, 'w').close()
+            return 0
+        self._log(". " + cmd + "\n")
+        seconds = self.cost(cmd)
+        if seconds:
+            time.sleep(seconds)
+        if cmd.startswith("graph export"):
+            filename = re.search(r'"(.+?)"', cmd).group(1)
+            with open(filename, 'wb') as f:
+                f.write(FAKE_PNG)
+            self._log("(file {} written in PNG format)\n".format(filename))
+        elif cmd.startswith('display "NBCACHE_SIG|"'):
+            self._log("NBCACHE_SIG|0|1000:22(12345):123456789:987654321|" +
+                      "synthetic data|s2color|80|13|period|1234567890\n")
+        elif cmd.startswith('display "'):
+            self._log(re.match(r'display "(.*?)"', cmd).group(1) + "\n")
+        elif cmd.startswith('global NBC_RFILE "'):
+            self.r_file = re.search(r'"(.+?)"', cmd).group(1)
+        elif cmd.startswith("capture mata: __nbc_t"):
+            # the Mata code that saves r()
+            with open(self.r_file, 'wb') as f:
+                f.write(b'r()')
+        elif cmd.split()[0] in ("capture", "quietly", "global", "_return",
+                                "if", "_nbc_rpost"):
+            pass
+        else:
+            self._log(FAKE_OUTPUT.get(cmd.split()[0], "") + "\n")
+        return 0
+
+    def UtilIsStataFreeEvent(self):
+        return True
+
+    def UtilSetStataBreak(self):
+        pass
+
+
+class FakeIPython():
+    def __init__(self):
+        self.magics = []
+
+    def register_magics(self, magics):
+        self.magics.append(magics)
+
+    def run_cell(self, raw_cell, store_history=False, silent=False,
+                 shell_futures=True):
+        pass
+
+
+class FakeTime():
+    """Stand-in for the time module in stata_interface, so that its
+    fixed waits for Stata do not swamp the time spent on output
+
+    """
+    time = staticmethod(time.time)
+
+    def sleep(self, seconds):
+        pass
+
+
+class FakeMsvcrt():
+    def _sopen(self, *args):
+        return 3  # file not opened by anyone else
+
+    def _close(self, *args):
+        return 0
+
+
+def load_stata_interface(work_dir, cache=False, nobs=10000, nvar=20):
+    """Run stata_interface.py against a FakeStata with nobs observations
+    and nvar variables, with its customized locations pointed at
+    work_dir, and return its namespace.
+
+    """
+    with open(os.path.join(HERE, "stata_interface.py")) as f:
+        source = f.read()
+
+    locations = {
+        "LOG_LOCATION": work_dir,
+        "GRAPH_LOCATION": work_dir,
+        "HELP_HTML_LOCATION": work_dir,
+        "CACHE_LOCATION": os.path.join(work_dir, "cache") if cache else None,
+    }
+    if cache:
+        os.makedirs(locations["CACHE_LOCATION"], exist_ok=True)
+    for name, value in locations.items():
+        source = re.sub(r'(?m)^{} = .*$'.format(name),
+                        '{} = {!r}'.format(name, value), source)
+
+    fake_client = types.ModuleType("win32com.client")
+    fake_client.Dispatch = lambda name: FakeStata(nobs, nvar)
+    fake_win32com = types.ModuleType("win32com")
+    fake_win32com.client = fake_client
+
+    saved_modules = {name: sys.modules.get(name)
+                     for name in ("win32com", "win32com.client")}
+    saved_cdll = ctypes.cdll
+    sys.modules["win32com"] = fake_win32com
+    sys.modules["win32com.client"] = fake_client
+    ctypes.cdll = types.SimpleNamespace(msvcrt=FakeMsvcrt())
+
+    namespace = {
+        "__name__": "stata_interface",
+        "get_ipython": FakeIPython,
+        "WindowsError": OSError,
+    }
+    try:
+        with redirect_stdout(io.StringIO()):
+            exec(compile(source, "stata_interface.py", "exec"), namespace)
+    finally:
+        ctypes.cdll = saved_cdll
+        for name, module in saved_modules.items():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+
+    namespace["time"] = FakeTime()
+    return namespace
+
+
+def bench_bridge(repeat, nobs, nvar):
+    """time cell round trips through MyMagics.do, with and without
+    the output cache, against a FakeStata with nobs observations and
+    nvar variables
+
+    """
+    results = {}
+    for cache in (False, True):
+        work_dir = tempfile.mkdtemp()
+        try:
+            namespace = load_stata_interface(work_dir, cache, nobs, nvar)
+            magics = namespace["MyMagics"](shell=None)
+
+            for name, cmd in (("cell_summarize", "summarize"),
+                              ("cell_graph", "scatter x0 x1")):
+                run_cell = lambda: magics.do("", cmd)
+                if not cache:
+                    results[name] = time_it(run_cell, repeat)
+                    continue
+
+                # runs that fill an empty cache, then runs that replay
+                cache_dir = namespace["CACHE_LOCATION"]
+                def clear_cache():
+                    for f in os.listdir(cache_dir):
+                        os.remove(os.path.join(cache_dir, f))
+                results[name + "_fill"] = time_it(
+                    run_cell, repeat, setup=clear_cache)
+                with redirect_stdout(io.StringIO()):
+                    run_cell()
+                results[name + "_cached"] = time_it(run_cell, repeat)
+            namespace["log_file"].close()
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+#-------------------------------------------------------------------------
+# running and comparing
+#-------------------------------------------------------------------------
+
+def compare(baseline, current):
+    """print comparison of two sets of results, and return the names
+    of benchmarks that are slower than their baseline thresholds;
+    raise ValueError if the runs used different workloads
+
+    """
+    base_meta, meta = baseline.get('meta', {}), current.get('meta', {})
+    differ = [key for key in WORKLOAD_KEYS
+              if base_meta.get(key) != meta.get(key)]
+    if differ:
+        raise ValueError("runs are not comparable, they differ in " +
+            ", ".join("{} ({} vs {})".format(
+                key, base_meta.get(key), meta.get(key)) for key in differ))
+    for key in ("python", "platform"):
+        if base_meta.get(key) != meta.get(key):
+            print("warning: runs differ in {} ({} vs {})".format(
+                key, base_meta.get(key), meta.get(key)))
+
+    tplt = "{:>24} {:>12} {:>12} {:>8}  {}"
+    print(tplt.format("benchmark", "baseline", "current", "ratio", ""))
+    regressions = []
+    base_results = baseline['results']
+    for name, result in sorted(current['results'].items()):
+        base = base_results.get(name)
+        if (base is None or 'min' not in base or 'min' not in result):
+            print(tplt.format(name, "-", "-", "-", "not compared"))
+            continue
+        ratio = result['min'] / base['min']
+        slower = (ratio > base.get('threshold', DEFAULT_THRESHOLD) and
+                  result['min'] - base['min'] > base.get('floor', DEFAULT_FLOOR))
+        if slower:
+            regressions.append(name)
+        print(tplt.format(name, "{:.6f}".format(base['min']),
+                          "{:.6f}".format(result['min']),
+                          "{:.2f}".format(ratio), "SLOWER" if slower else "ok"))
+    return regressions
+
+
+def run(args):
+    results = {}
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        address = os.path.join(work_dir, "synthetic.dta")
+        make_dta117(address, args.rows, args.cols, args.missing, args.seed)
+        try:
+            results.update(bench_units(address, args.repeat))
+        except ImportError as e:
+            results['units'] = {'skipped': str(e)}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if not args.no_bridge:
+        try:
+            results.update(bench_bridge(args.bridge_repeat,
+                                        args.rows, args.cols))
+        except ImportError as e:
+            results['bridge'] = {'skipped': str(e)}
+
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'rows': args.rows,
+            'cols': args.cols,
+            'missing': args.missing,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'bridge_repeat': None if args.no_bridge else args.bridge_repeat,
+            'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="benchmark units_dta and the notebook interface")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--cols", type=int, default=20)
+    parser.add_argument("--missing", type=float, default=0.05,
+        help="fraction of numeric values that are missing")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--bridge-repeat", type=int, default=25,
+        help="repeats for notebook cells")
+    parser.add_argument("--no-bridge", action="store_true",
+        help="skip the notebook interface benchmarks")
+    parser.add_argument("--output", default="benchmark.json",
+        help="file to write results to, as JSON")
+    parser.add_argument("--baseline",
+        help="results of an earlier run to compare against")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+        help="only compare two earlier runs")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+        try:
+            return 1 if compare(baseline, current) else 0
+        except ValueError as e:
+            print(e)
+            return 2
+
+    current = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(current, f, indent=2)
+
+    for name, result in sorted(current['results'].items()):
+        if 'skipped' in result:
+            print("{:>24}: skipped ({})".format(name, result['skipped']))
+        else:
+            print("{:>24}: {:.6f} s min, {:.6f} s median of {}".format(
+                name, result['min'], result['median'], result['runs']))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("")
+        try:
+            return 1 if compare(baseline, current) else 0
+        except ValueError as e:
+            print(e)
+            return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+import struct
+
+import pytest
+
+
+# struct code and smallest missing value for each numeric type,
+# as written by Stata (not taken from the modules under test)
+NUM_CODES = {
+    65530: ('b', 101),
+    65529: ('h', 32741),
+    65528: ('i', 2147483621),
+    65527: ('f', 0x7f000000),
+    65526: ('d', 0x7fe0000000000000),
+}
+STRL = 32768
+
+
+def pack_value(value, typ, bo):
+    """pack a value as it appears in the data section: numbers, missing
+    values as str ('.', '.a' - '.z'), str, or (v, o) for strLs
+
+    """
+    if typ == STRL:
+        return struct.pack(bo + 'II', *value)
+    if typ not in NUM_CODES:
+        return value.encode('iso-8859-1').ljust(typ, b'\0')
+    code, miss_min = NUM_CODES[typ]
+    if isinstance(value, str):
+        index = 0 if value == '.' else ord(value[1]) - 96
+        if code == 'f':
+            return struct.pack(bo + 'I', miss_min + (index << 11))
+        if code == 'd':
+            return struct.pack(bo + 'Q', miss_min + (index << 40))
+        return struct.pack(bo + code, miss_min + index)
+    return struct.pack(bo + code, value)
+
+
+def write_dta117(address, varlist, typlist, rows, chrdict=None,
+                 strls=(), byteorder='<', data_label="test data"):
+    """Write a version 117 dta file. strls are (v, o, contents, binary)
+    tuples; ASCII contents are written with their trailing null.
+
+    """
+    bo = byteorder
+    nvar = len(varlist)
+    chrdict = chrdict or {}
+
+    def section(tag, body):
+        return b''.join((b'<', tag, b'>', body, b'</', tag, b'>'))
+
+    def fixed(strs, width):
+        return b''.join(s.encode('iso-8859-1').ljust(width, b'\0')
+                        for s in strs)
+
+    label = data_label.encode('iso-8859-1')
+    header = b''.join((
+        b'<header><release>117</release><byteorder>',
+        b'MSF' if bo == '>' else b'LSF', b'</byteorder>',
+        b'<K>', struct.pack(bo + 'H', nvar), b'</K>',
+        b'<N>', struct.pack(bo + 'I', len(rows)), b'</N>',
+        b'<label>', bytes([len(label)]), label, b'</label>',
+        b'<timestamp>', bytes([17]), b' 1 Jan 2014 00:00', b'</timestamp>',
+        b'</header>'
+    ))
+
+    chrs = [b'<characteristics>']
+    for varname, var_chrs in chrdict.items():
+        for charname, contents in var_chrs.items():
+            contents = contents.encode('iso-8859-1') + b'\0'
+            chrs.extend((b'<ch>', struct.pack(bo + 'I', 66 + len(contents)),
+                         fixed([varname], 33), fixed([charname], 33),
+                         contents, b'</ch>'))
+    chrs.append(b'</characteristics>')
+
+    gsos = [b'<strls>']
+    for v, o, contents, binary in strls:
+        if not binary:
+            contents += b'\0'
+        gsos.extend((b'GSO', struct.pack(bo + 'IIBI', v, o,
+                                         129 if binary else 130,
+                                         len(contents)),
+                     contents))
+    gsos.append(b'</strls>')
+
+    data = b''.join(pack_value(value, typ, bo)
+                    for row in rows for value, typ in zip(row, typlist))
+
+    parts = [
+        b'<stata_dta>' + header,
+        None,  # map
+        section(b'variable_types', struct.pack(bo + str(nvar) + 'H', *typlist)),
+        section(b'varnames', fixed(varlist, 33)),
+        section(b'sortlist', b'\0' * 2 * (nvar + 1)),
+        section(b'formats', fixed(["%9.0g"] * nvar, 49)),
+        section(b'value_label_names', b'\0' * 33 * nvar),
+        section(b'variable_labels', fixed(["label " + v for v in varlist], 81)),
+        b''.join(chrs),
+        section(b'data', data),
+        b''.join(gsos),
+        section(b'value_labels', b''),
+        b'</stata_dta>',
+    ]
+    offsets = [0]
+    pos = len(parts[0])
+    for part in parts[1:]:
+        offsets.append(pos)
+        pos += 5 + 112 + 6 if part is None else len(part)
+    offsets.append(pos)
+    parts[1] = b'<map>' + struct.pack(bo + '14Q', *offsets) + b'</map>'
+
+    with open(address, 'wb') as dta_file:
+        dta_file.write(b''.join(parts))
+
+
+@pytest.fixture
+def make_dta(tmp_path):
+    """return function writing a version 117 file in tmp_path"""
+    def make(name="test.dta", **kwargs):
+        address = str(tmp_path / name)
+        write_dta117(address, **kwargs)
+        return address
+    return make
@@ -0,0 +1,543 @@
+import io
+import os
+import json
+import struct
+import hashlib
+import argparse
+import tempfile
+import threading
+from functools import partial
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+try:
+    from stata_dta import Dta117
+    HAS_STATA_DTA = True
+except ImportError:
+    HAS_STATA_DTA = False
+try:
+    from PIL import Image
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+
+# sizes and struct codes for the numeric types of version 117 dta files,
+# and the smallest raw value that represents a missing value
+NUM_TYPES = {
+    65530: (1, 'b', 101),
+    65529: (2, 'h', 32741),
+    65528: (4, 'i', 2147483621),
+    65527: (4, 'f', 0x7f000000),
+    65526: (8, 'd', 0x7fe0000000000000),
+}
+STRL = 32768
+
+STRL_BINARY = 129
+STRL_ASCII = 130
+
+# maximum number of rows served in a single window
+MAX_WINDOW = 5000
+
+# ASCII strLs up to this length are sent with rows, others on request
+STRL_INLINE_LEN = 2045
+
+# thumbnail sizes, in pixels; other requested sizes are rounded to
+# one of these, so the thumbnail cache holds at most this many per image
+THUMB_SIZES = (50, 100, 200, 400)
+
+# files of this repository that the viewer page needs
+HERE = os.path.dirname(os.path.abspath(__file__))
+PAGE_FILES = ("read_dta.html", "StataDta.js")
+
+# read_dta.html loads SlickGrid from ../SlickGrid, which is served as
+# /SlickGrid when the page is served as /read_dta.html
+SLICKGRID_DIR = os.path.join(os.path.dirname(HERE), "SlickGrid")
+
+# (magic bytes, media type) for sniffing binary strL contents
+MEDIA_TYPES = (
+    (b'\x89PNG', "image/png"),
+    (b'\xff\xd8\xff', "image/jpeg"),
+    (b'GIF8', "image/gif"),
+    (b'BM', "image/bmp"),
+    (b'ID3', "audio/mpeg"),
+    (b'\xff\xfb', "audio/mpeg"),
+    (b'RIFF', "audio/wav"),
+    (b'OggS', "audio/ogg"),
+)
+
+
+def missing_str(index):
+    """return '.' for index 0, '.a' - '.z' for index 1 - 26"""
+    return '.' if index == 0 else '.' + chr(96 + index)
+
+
+def media_type(payload):
+    """guess media type of binary strL from its first bytes"""
+    for magic, mtype in MEDIA_TYPES:
+        if payload.startswith(magic):
+            return mtype
+    return "application/octet-stream"
+
+
+def thumb_size(requested):
+    """return smallest of THUMB_SIZES that is at least requested,
+    or the largest if none are
+
+    """
+    for size in THUMB_SIZES:
+        if size >= requested:
+            return size
+    return THUMB_SIZES[-1]
+
+
+class LRUCache():
+    """Thread-safe mapping that drops least recently used values
+    once the total size of its values exceeds max_bytes.
+
+    """
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        if len(value) > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._nbytes -= len(self._items.pop(key))
+            self._items[key] = value
+            self._nbytes += len(value)
+            while self._nbytes > self._max_bytes:
+                old_key, old_value = self._items.popitem(last=False)
+                self._nbytes -= len(old_value)
+
+
+class DtaWindow():
+    """Random access to the rows of a version 117 dta file.
+
+    Only the header, descriptors, and characteristics are read when the
+    file is opened. Data rows are fixed width, so the row-offset index
+    is just the start of the data section and the row length, and any
+    window of rows can be read with a single seek.
+
+    strL contents are not read when the file is opened. Only the 
+    (v, o) keys and the offsets of their contents are recorded, and 
+    contents are read when requested, with recently used contents 
+    kept in an LRU cache of at most cache_bytes bytes.
+
+    """
+    def __init__(self, address, cache_bytes=64 * 2**20):
+        self._address = address
+        self._lock = threading.Lock()
+        self._file = open(address, 'rb')
+        self._strl_cache = LRUCache(cache_bytes)
+        self._strl_hashes = {}
+        try:
+            self._read_descriptors()
+            self._index_strls()
+        except:
+            self._file.close()
+            raise
+
+    def close(self):
+        self._file.close()
+
+    def _read(self, offset, size):
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(size)
+
+    def _read_descriptors(self):
+        head = self._read(0, 83)
+        if (not head.startswith(b'<stata_dta><header><release>117</release>')
+                or head[67:70] != b'<K>' or head[72:79] != b'</K><N>'):
+            raise ValueError("not a version 117 dta file")
+        bo = self._byteorder = '>' if head[52:55] == b'MSF' else '<'
+        nvar = self._nvar = struct.unpack(bo + 'H', head[70:72])[0]
+        self._nobs, = struct.unpack(bo + 'I', head[79:83])
+
+        # data label and time stamp
+        rest = self._read(83, 400)
+        lbl_len = rest[11]  # after '</N><label>'
+        self._data_label = rest[12:12 + lbl_len].decode('iso-8859-1')
+
+        map_pos = 83 + rest.find(b'<map>') + 5
+        self._map = struct.unpack(bo + '14Q', self._read(map_pos, 112))
+
+        smap = self._map
+        raw = self._read(smap[2] + 16, 2 * nvar)
+        self._typlist = list(struct.unpack(bo + str(nvar) + 'H', raw))
+
+        def fixed_strs(offset, width):
+            raw = self._read(offset, width * nvar)
+            return [raw[width*i:width*(i+1)].split(b'\0')[0].decode('iso-8859-1')
+                    for i in range(nvar)]
+
+        self._varlist = fixed_strs(smap[3] + 10, 33)
+        raw = self._read(smap[4] + 10, 2 * (nvar + 1))
+        self._srtlist = list(struct.unpack(bo + str(nvar + 1) + 'H', raw))[:-1]
+        self._fmtlist = fixed_strs(smap[5] + 9, 49)
+        self._lbllist = fixed_strs(smap[6] + 19, 33)
+        self._vlblist = fixed_strs(smap[7] + 17, 81)
+        self._chrdict = self._read_chrs()
+
+        # row-offset index
+        widths = [NUM_TYPES[t][0] if t in NUM_TYPES else
+                  (8 if t == STRL else t) for t in self._typlist]
+        self._widths = widths
+        self._rowlen = sum(widths)
+        self._data_start = smap[9] + 6
+
+    def _index_strls(self):
+        """record offset, type, and length of each strL, keyed by (v, o)"""
+        bo = self._byteorder
+        gso_head = struct.Struct(bo + 'IIBI')
+        pos = self._map[10] + 7  # skip '<strls>'
+        stop = self._map[11] - 8  # '</strls>'
+        index = {}
+        while pos < stop:
+            head = self._read(pos, 16)
+            if head[:3] != b'GSO':
+                raise ValueError("malformed strls section")
+            v, o, t, length = gso_head.unpack_from(head, 3)
+            index[(v, o)] = (pos + 16, t, length)
+            pos += 16 + length
+        self._strl_index = index
+
+    def strl(self, v, o):
+        """return (contents, is_binary) of the strL with key (v, o)"""
+        if (v, o) not in self._strl_index:
+            raise ValueError("no strL with v={}, o={}".format(v, o))
+        offset, t, length = self._strl_index[(v, o)]
+        contents = self._strl_cache.get((v, o))
+        if contents is None:
+            contents = self._read(offset, length)
+            self._strl_cache.put((v, o), contents)
+        if t == STRL_ASCII:
+            return contents.rstrip(b'\0'), False
+        return contents, True
+
+    def thumbnail(self, v, o, size, cache_dir):
+        """return (contents, media type) of image strL scaled to fit in 
+        size x size pixels, creating it in cache_dir if needed; if
+        the strL cannot be scaled, return the original contents
+
+        """
+        contents, is_binary = self.strl(v, o)
+        mtype = media_type(contents)
+        if not HAS_PIL or not mtype.startswith("image/"):
+            return contents, mtype
+
+        # thumbnails are keyed by content hash, so identical images
+        # (and the same file served again later) share a thumbnail
+        if (v, o) not in self._strl_hashes:
+            self._strl_hashes[(v, o)] = hashlib.sha1(contents).hexdigest()
+        thumb_path = os.path.join(cache_dir, 
+            "{}_{}.png".format(self._strl_hashes[(v, o)], size))
+
+        if not os.path.exists(thumb_path):
+            tmp_path = "{}.{}.tmp".format(thumb_path, threading.get_ident())
+            try:
+                image = Image.open(io.BytesIO(contents))
+                image.thumbnail((size, size))
+                image.save(tmp_path, "PNG")
+                os.replace(tmp_path, thumb_path)
+            except Exception:
+                # any Pillow failure (unreadable image, decompression
+                # bomb, etc.) falls back to the original image
+                return contents, mtype
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        with open(thumb_path, 'rb') as f:
+            return f.read(), "image/png"
+
+    def _read_chrs(self):
+        """read characteristics into dict of dicts, as in Dta117._chrdict"""
+        bo = self._byteorder
+        start, stop = self._map[8] + 17, self._map[9] - 18
+        raw = self._read(start, stop - start)
+        chrdict = {}
+        pos = 0
+        while raw.startswith(b'<ch>', pos):
+            length, = struct.unpack(bo + 'I', raw[pos + 4:pos + 8])
+            entry = raw[pos + 8:pos + 8 + length]
+            varname = entry[:33].split(b'\0')[0].decode('iso-8859-1')
+            charname = entry[33:66].split(b'\0')[0].decode('iso-8859-1')
+            contents = entry[66:].split(b'\0')[0].decode('iso-8859-1')
+            chrdict.setdefault(varname, {})[charname] = contents
+            pos += 8 + length + 5  # '<ch>', length, entry, '</ch>'
+        return chrdict
+
+    def metadata(self):
+        """return column metadata, including characteristics such as _units"""
+        return {
+            'nobs': self._nobs,
+            'nvar': self._nvar,
+            'data_label': self._data_label,
+            'varlist': self._varlist,
+            'typlist': self._typlist,
+            'srtlist': self._srtlist,
+            'fmtlist': self._fmtlist,
+            'lbllist': self._lbllist,
+            'vlblist': self._vlblist,
+            'chrdict': self._chrdict,
+        }
+
+    def _check_window(self, start, stop):
+        start = max(0, start)
+        stop = min(self._nobs, stop, start + MAX_WINDOW)
+        return start, max(start, stop)
+
+    def raw_rows(self, start, stop):
+        """return rows start to stop - 1 as bytes, exactly as in file"""
+        start, stop = self._check_window(start, stop)
+        rowlen = self._rowlen
+        return start, stop, self._read(self._data_start + start * rowlen,
+                                       (stop - start) * rowlen)
+
+    def rows(self, start, stop):
+        """return rows start to stop - 1 as lists of Python values;
+        missing values are given as str ('.', '.a', etc.)
+
+        """
+        start, stop, raw = self.raw_rows(start, stop)
+        bo = self._byteorder
+        typlist = self._typlist
+        widths = self._widths
+        rowlen = self._rowlen
+
+        # build one decoder per column
+        decoders = []
+        pos = 0
+        for typ, width in zip(typlist, widths):
+            if typ == STRL:
+                fmt = struct.Struct(bo + 'II')
+                decoder = (lambda row, p=pos, f=fmt:
+                                self._strl_value(*f.unpack_from(row, p)))
+            elif typ in NUM_TYPES:
+                decoder = self._num_decoder(typ, pos)
+            else:
+                decoder = (lambda row, p=pos, w=width:
+                                row[p:p + w].split(b'\0')[0].decode('iso-8859-1'))
+            decoders.append(decoder)
+            pos += width
+
+        rows = []
+        for i in range(stop - start):
+            row = raw[i * rowlen:(i + 1) * rowlen]
+            rows.append([decode(row) for decode in decoders])
+        return start, stop, rows
+
+    def _num_decoder(self, typ, pos):
+        bo = self._byteorder
+        size, code, miss_min = NUM_TYPES[typ]
+        val_fmt = struct.Struct(bo + code)
+        if code == 'f' or code == 'd':
+            bits_fmt = struct.Struct(bo + ('I' if code == 'f' else 'Q'))
+            shift = 11 if code == 'f' else 40
+            def decoder(row):
+                bits, = bits_fmt.unpack_from(row, pos)
+                if bits >= miss_min and bits < miss_min + (27 << shift):
+                    return missing_str((bits - miss_min) >> shift)
+                return val_fmt.unpack_from(row, pos)[0]
+        else:
+            def decoder(row):
+                val, = val_fmt.unpack_from(row, pos)
+                if val >= miss_min:
+                    return missing_str(val - miss_min)
+                return val
+        return decoder
+
+    def _strl_value(self, v, o):
+        """return short ASCII strLs as str, others as {'strl': [v, o]}"""
+        if v == 0 and o == 0:
+            return ""
+        offset, t, length = self._strl_index.get((v, o), (0, 0, 0))
+        if t == STRL_ASCII and length <= STRL_INLINE_LEN:
+            return self.strl(v, o)[0].decode('iso-8859-1')
+        return {'strl': [v, o], 'binary': t == STRL_BINARY}
+
+
+class InMemoryWindow(DtaWindow):
+    """Serve windows of a dta file of any version readable by stata_dta.
+
+    The whole file is read by Dta117, so this does not help with large
+    files, but it lets version 114 and 115 files use the same viewer.
+
+    """
+    def __init__(self, address):
+        if not HAS_STATA_DTA:
+            raise ValueError("stata_dta module needed for non-117 files")
+        dta = Dta117(address)
+        self._dta = dta
+        self._nobs = len(dta._varvals)
+        self._nvar = len(dta._varlist)
+        self._data_label = dta._data_label
+        self._varlist = dta._varlist
+        self._typlist = dta._typlist
+        self._srtlist = [s for s in dta._srtlist if s is not None]
+        self._fmtlist = dta._fmtlist
+        self._lbllist = dta._lbllist
+        self._vlblist = dta._vlblist
+        self._chrdict = dta._chrdict
+
+    def close(self):
+        pass
+
+    def raw_rows(self, start, stop):
+        raise ValueError("binary windows need a version 117 file")
+
+    def strl(self, v, o):
+        raise ValueError("strL requests need a version 117 file")
+
+    def thumbnail(self, v, o, size, cache_dir):
+        raise ValueError("strL requests need a version 117 file")
+
+    def rows(self, start, stop):
+        start, stop = self._check_window(start, stop)
+        rows = [[v if isinstance(v, (int, float, str)) else 
+                    "(binary)" if isinstance(v, bytes) else str(v)
+                 for v in row]
+                for row in self._dta._varvals[start:stop]]
+        return start, stop, rows
+
+
+def open_window(address, cache_bytes=64 * 2**20):
+    """open dta file as DtaWindow, falling back to InMemoryWindow"""
+    with open(address, 'rb') as f:
+        is117 = f.read(41).startswith(b'<stata_dta><header><release>117')
+    if is117:
+        return DtaWindow(address, cache_bytes)
+    return InMemoryWindow(address)
+
+
+class DtaRequestHandler(SimpleHTTPRequestHandler):
+    """Serve the viewer page (/read_dta.html, /StataDta.js, and
+    /SlickGrid/...), without directory listings, plus
+
+    /meta                             column metadata, as JSON
+    /rows?start=i&stop=j              rows i to j - 1, as JSON
+    /rows?start=i&stop=j&format=bin   rows i to j - 1, as raw file bytes
+    /strl?v=v&o=o                     contents of strL (v, o)
+    /thumb?v=v&o=o&size=s             image strL (v, o) scaled to s pixels,
+                                      s rounded to one of THUMB_SIZES
+
+    """
+    window = None
+    thumb_dir = None
+
+    def translate_path(self, path):
+        """map allowed paths to files; anything else maps to a path 
+        that does not exist, so the request gets a 404
+        
+        """
+        path = urlparse(path).path
+        if path.lstrip("/") in PAGE_FILES:
+            return os.path.join(HERE, path.lstrip("/"))
+        if path.startswith("/SlickGrid/"):
+            root = os.path.realpath(SLICKGRID_DIR)
+            full = os.path.realpath(
+                SimpleHTTPRequestHandler.translate_path(self, path[10:]))
+            if full.startswith(root + os.sep) and os.path.isfile(full):
+                return full
+        return os.path.join(HERE, "__not_found__")
+
+    def list_directory(self, path):
+        self.send_error(404, "File not found")
+        return None
+
+    def _send(self, body, content_type, extra_headers=()):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in extra_headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, obj):
+        self._send(json.dumps(obj).encode('utf-8'), "application/json")
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        try:
+            if url.path == "/meta":
+                self._send_json(self.window.metadata())
+            elif url.path == "/rows":
+                start = int(query.get('start', ['0'])[0])
+                stop = int(query.get('stop', [str(start + 100)])[0])
+                if query.get('format', ['json'])[0] == 'bin':
+                    start, stop, raw = self.window.raw_rows(start, stop)
+                    self._send(raw, "application/octet-stream",
+                               (("X-Dta-Start", str(start)),
+                                ("X-Dta-Stop", str(stop))))
+                else:
+                    start, stop, rows = self.window.rows(start, stop)
+                    self._send_json({'start': start, 'stop': stop, 'rows': rows})
+            elif url.path == "/strl":
+                v, o = int(query['v'][0]), int(query['o'][0])
+                contents, is_binary = self.window.strl(v, o)
+                mtype = (media_type(contents) if is_binary else
+                         "text/plain; charset=iso-8859-1")
+                # strL contents never change while the file is served
+                self._send(contents, mtype, 
+                           (("Cache-Control", "max-age=3600"),))
+            elif url.path == "/thumb":
+                v, o = int(query['v'][0]), int(query['o'][0])
+                size = thumb_size(int(query.get('size', ['100'])[0]))
+                contents, mtype = self.window.thumbnail(
+                    v, o, size, self.thumb_dir)
+                self._send(contents, mtype, 
+                           (("Cache-Control", "max-age=3600"),))
+            else:
+                SimpleHTTPRequestHandler.do_GET(self)
+        except (ValueError, KeyError) as e:
+            self.send_error(400, str(e))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="serve windows of rows of a dta file to read_dta.html")
+    parser.add_argument("address", help="dta file to serve")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--thumb-dir", 
+        default=os.path.join(tempfile.gettempdir(), "dta_thumbnails"),
+        help="directory for cached image thumbnails")
+    parser.add_argument("--cache-mb", type=int, default=64,
+        help="memory for recently used strL contents, in MB")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.thumb_dir, exist_ok=True)
+    DtaRequestHandler.thumb_dir = args.thumb_dir
+    DtaRequestHandler.window = open_window(args.address, args.cache_mb * 2**20)
+
+    handler = partial(DtaRequestHandler, directory=SLICKGRID_DIR)
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    print("serving {} at http://{}:{}/read_dta.html".format(
+        args.address, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        DtaRequestHandler.window.close()
+
+
+if __name__ == "__main__":
+    main()
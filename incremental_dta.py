@@ -0,0 +1,281 @@
+import os
+import math
+import shutil
+import struct
+import numbers
+import tempfile
+
+
+# sizes, struct codes, and (min, max) of nonmissing values
+# for the numeric types of version 117 dta files
+DTA117_NUM_TYPES = {
+    65530: (1, 'b', -127, 100),
+    65529: (2, 'h', -32767, 32740),
+    65528: (4, 'i', -2147483647, 2147483620),
+    65527: (4, 'f', -1.70141173319e+38, 1.70141173319e+38),
+    65526: (8, 'd', -8.9884656743e+307, 8.9884656743e+307),
+}
+DTA117_STRL = 32768
+
+# tags marking the start of the sections listed in the version 117 map
+DTA117_MAP_TAGS = (
+    b'<stata_dta>', b'<map>', b'<variable_types>', b'<varnames>',
+    b'<sortlist>', b'<formats>', b'<value_label_names>',
+    b'<variable_labels>', b'<characteristics>', b'<data>', b'<strls>',
+    b'<value_labels>', b'</stata_dta>', b''
+)
+
+
+class _FullRewrite(Exception):
+    """incremental save is not possible; file must be rewritten"""
+    pass
+
+
+class IncrementalSave():
+    """Mixin for Dta117 subclasses, making save() rewrite only the
+    characteristics and the changed columns of the file when every
+    change since the last save was recorded with `_mark_dirty`.
+
+    Any other change forces a full rewrite. Dta117 methods record
+    changes by setting `_changed`, which is a property here, so
+    every direct assignment of `_changed = True` is seen.
+
+    """
+
+    @property
+    def _changed(self):
+        return self.__dict__.get("_changed_flag", False)
+
+    @_changed.setter
+    def _changed(self, value):
+        self._changed_flag = value
+        if value:
+            self._untracked_change = True
+        else:
+            self._clear_dirty()
+
+    @property
+    def changed(self):
+        return self._changed
+
+    @changed.setter
+    def changed(self, value):
+        self._changed = value
+
+    def _clear_dirty(self):
+        self._dirty_chrs = set()
+        self._dirty_cols = set()
+        self._untracked_change = False
+
+    def _mark_dirty(self, varname, data=False):
+        """record that characteristics (and data, if `data`) of
+        varname have changed
+
+        """
+        if not self._changed:
+            self._clear_dirty()
+        self._dirty_chrs.add(varname)
+        if data:
+            self._dirty_cols.add(varname)
+        self._changed_flag = True
+
+    def save(self, address=None, replace=False):
+        """Save current instance to dta file.
+
+        If the only changes since the file was opened (or last saved)
+        were recorded with `_mark_dirty`, and the file is being saved
+        to the same address, only the characteristics section and the
+        changed columns of the data section are rewritten. Otherwise
+        the entire file is rewritten.
+
+        """
+        fullpath = getattr(self, "_fullpath", None)
+        if (self._changed and fullpath is not None and
+                not getattr(self, "_untracked_change", True) and
+                (self._dirty_chrs or self._dirty_cols) and
+                (address is None or (replace and
+                    os.path.abspath(address) == os.path.abspath(fullpath))) and
+                os.path.isfile(fullpath)):
+            try:
+                self._save_incremental(fullpath)
+            except _FullRewrite:
+                pass
+            else:
+                self._changed = False
+                return
+
+        super().save(address, replace)
+        self._changed = False
+
+    def _read_dta117_layout(self, dta_file):
+        """read byteorder, map, and variable types from version 117 file"""
+        dta_file.seek(0)
+        head = dta_file.read(83)
+        if (not head.startswith(b'<stata_dta><header><release>117</release>')
+                or head[67:70] != b'<K>' or head[72:79] != b'</K><N>'):
+            raise _FullRewrite
+        byteorder = '>' if head[52:55] == b'MSF' else '<'
+        nvar, = struct.unpack(byteorder + 'H', head[70:72])
+        nobs, = struct.unpack(byteorder + 'I', head[79:83])
+
+        # map follows the data label and time stamp, which are short
+        map_pos = dta_file.read(400).find(b'<map>')
+        if map_pos == -1:
+            raise _FullRewrite
+        dta_file.seek(83 + map_pos + 5)
+        offsets = list(struct.unpack(byteorder + '14Q', dta_file.read(112)))
+
+        # check that each offset points to the expected tag
+        for offset, tag in zip(offsets, DTA117_MAP_TAGS):
+            if not tag:
+                continue
+            dta_file.seek(offset)
+            if dta_file.read(len(tag)) != tag:
+                raise _FullRewrite
+
+        dta_file.seek(offsets[2] + 16)
+        typlist = struct.unpack(byteorder + str(nvar) + 'H',
+                                dta_file.read(2 * nvar))
+        dta_file.seek(offsets[3] + 10)
+        raw_names = dta_file.read(33 * nvar)
+        varlist = [raw_names[33*i:33*(i+1)].split(b'\0')[0].decode('iso-8859-1')
+                   for i in range(nvar)]
+
+        return byteorder, nobs, offsets, typlist, varlist
+
+    def _chrs_to_bytes(self, byteorder):
+        """make version 117 characteristics section from _chrdict"""
+        chunks = [b'<characteristics>']
+        for varname, var_chrs in self._chrdict.items():
+            vname = varname.encode('iso-8859-1')[:32].ljust(33, b'\0')
+            for charname, contents in var_chrs.items():
+                cname = charname.encode('iso-8859-1')[:32].ljust(33, b'\0')
+                contents = contents.encode('iso-8859-1') + b'\0'
+                chunks.extend((
+                    b'<ch>',
+                    struct.pack(byteorder + 'I', 66 + len(contents)),
+                    vname, cname, contents,
+                    b'</ch>'
+                ))
+        chunks.append(b'</characteristics>')
+        return b''.join(chunks)
+
+    def _pack_col_value(self, value, typ, byteorder):
+        """pack a single value of a dirty column; raise _FullRewrite
+        if value does not fit in the column's current storage type
+
+        """
+        if typ == DTA117_STRL:
+            raise _FullRewrite
+        if typ not in DTA117_NUM_TYPES:  # str type of width typ
+            if not isinstance(value, str):
+                raise _FullRewrite
+            try:
+                value = value.encode('iso-8859-1')
+            except UnicodeEncodeError:
+                raise _FullRewrite from None
+            if len(value) > typ:
+                raise _FullRewrite
+            return value.ljust(typ, b'\0')
+
+        size, code, min_val, max_val = DTA117_NUM_TYPES[typ]
+        if value is None or not isinstance(value, numbers.Real):
+            # missing value; index 0 for '.', 1 - 26 for '.a' - '.z'
+            mv_str = '.' if value is None else str(value)
+            if not (mv_str == '.' or
+                    (len(mv_str) == 2 and 'a' <= mv_str[1] <= 'z')):
+                raise _FullRewrite
+            mv_index = 0 if mv_str == '.' else ord(mv_str[1]) - 96
+            if code == 'f':
+                return struct.pack(byteorder + 'I',
+                                   0x7f000000 + mv_index * 0x800)
+            if code == 'd':
+                return struct.pack(byteorder + 'Q',
+                                   0x7fe0000000000000 + mv_index * 0x10000000000)
+            return struct.pack(byteorder + code, max_val + 1 + mv_index)
+
+        # NaN and inf are not Stata values; let the full save handle them
+        if not math.isfinite(value) or not min_val <= value <= max_val:
+            raise _FullRewrite
+        if code not in 'fd':
+            if value != int(value):
+                raise _FullRewrite
+            value = int(value)
+        try:
+            return struct.pack(byteorder + code, value)
+        except (struct.error, OverflowError):
+            raise _FullRewrite from None
+
+    def _save_incremental(self, fullpath):
+        """patch characteristics and dirty columns of existing file"""
+        with open(fullpath, 'rb') as dta_file:
+            layout = self._read_dta117_layout(dta_file)
+        byteorder, nobs, offsets, typlist, varlist = layout
+
+        varvals = self._varvals
+        if nobs != len(varvals) or varlist != list(self._varlist):
+            raise _FullRewrite
+
+        widths = [DTA117_NUM_TYPES[t][0] if t in DTA117_NUM_TYPES else
+                  (8 if t == DTA117_STRL else t) for t in typlist]
+        rowlen = sum(widths)
+        if offsets[10] - offsets[9] != rowlen * nobs + 13:
+            raise _FullRewrite
+
+        # pack dirty columns before touching the file, so that a value
+        # that does not fit its storage type can still fall back safely
+        col_info = []
+        for varname in self._dirty_cols:
+            index = varlist.index(varname)
+            pos = sum(widths[:index])
+            typ = typlist[index]
+            packed = [self._pack_col_value(row[index], typ, byteorder)
+                      for row in varvals]
+            col_info.append((pos, widths[index], packed))
+
+        # characteristics: patch in place if size is unchanged,
+        # otherwise shift everything after them and update the map
+        if self._dirty_chrs:
+            new_chrs = self._chrs_to_bytes(byteorder)
+            delta = len(new_chrs) - (offsets[9] - offsets[8])
+            if delta == 0:
+                with open(fullpath, 'r+b') as dta_file:
+                    dta_file.seek(offsets[8])
+                    dta_file.write(new_chrs)
+            else:
+                new_offsets = offsets[:9] + [o + delta for o in offsets[9:]]
+                map_pos = offsets[1] + 5
+                dirname = os.path.dirname(os.path.abspath(fullpath))
+                fd, tmp_path = tempfile.mkstemp(suffix='.dta', dir=dirname)
+                try:
+                    with open(fullpath, 'rb') as src, \
+                            os.fdopen(fd, 'wb') as dst:
+                        dst.write(src.read(map_pos))
+                        dst.write(struct.pack(byteorder + '14Q', *new_offsets))
+                        src.seek(map_pos + 112)
+                        dst.write(src.read(offsets[8] - map_pos - 112))
+                        dst.write(new_chrs)
+                        src.seek(offsets[9])
+                        shutil.copyfileobj(src, dst)
+                    shutil.copymode(fullpath, tmp_path)
+                    os.replace(tmp_path, fullpath)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                offsets = new_offsets
+
+        # data: rewrite only the fields of dirty columns, in row blocks
+        if col_info:
+            data_start = offsets[9] + 6  # skip '<data>'
+            block_rows = max(1, (1 << 20) // max(rowlen, 1))
+            with open(fullpath, 'r+b') as dta_file:
+                for first in range(0, nobs, block_rows):
+                    last = min(first + block_rows, nobs)
+                    dta_file.seek(data_start + first * rowlen)
+                    block = bytearray(dta_file.read((last - first) * rowlen))
+                    for pos, width, packed in col_info:
+                        for i in range(first, last):
+                            start = (i - first) * rowlen + pos
+                            block[start:start + width] = packed[i]
+                    dta_file.seek(data_start + first * rowlen)
+                    dta_file.write(block)
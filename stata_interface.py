@@ -5,6 +5,9 @@ import win32com.client
 import time
 import os
 import re
+import shutil
+import hashlib
+import tempfile
 
 
 
@@ -35,6 +38,22 @@ ADOPATH = [
     'C:/ado/'
 ]
 
+# Output of cells that only describe or graph the data (summarize,
+# tabulate, scatter, etc.) can be cached here, and replayed instead of
+# re-run when the data and settings have not changed.
+# Set to None to turn off caching.
+# Create this directory if it doesn't already exist.
+CACHE_LOCATION = None
+
+# Cached output older than this many days is removed, and the oldest 
+# output is removed when the cache grows beyond this many megabytes.
+CACHE_MAX_AGE_DAYS = 30
+CACHE_MAX_MB = 200
+
+# Cacheable cells wait this many seconds for Stata to finish. Output
+# of cells that take longer is shown as usual, but not cached.
+CACHE_WAIT_SECONDS = 600
+
 #-------------------------------------------------------------------------
 
 
@@ -91,7 +110,9 @@ def print_output():
     line_count = 0
     log_line = log_file.readline()
     while log_line:
-        print(log_line[:-1])
+        if not (internal_echo.match(log_line) or 
+                log_line.startswith(DONE_MARKER)):
+            print(log_line[:-1])
         log_line = log_file.readline()
         
 def suppress_output():
@@ -212,6 +233,356 @@ def is_image_cmd(cmd):
     if cmd0_len >= 4 and cmd0 == "histogram"[:cmd0_len]: return True
     return False
 
+# commands (and minimum abbreviations) whose output can be cached.
+# Commands in the first group leave no r() or e() results, so cached
+# output is simply replayed. Commands in the second group leave r()
+# results that later cells may use, so r() is saved with their output, 
+# and posted again on a cache hit.
+replay_cmds = (
+    ("list", 1), ("table", 5), ("twoway", 2), ("scatter", 2), ("line", 4)
+)
+rclass_cmds = (
+    ("summarize", 2), ("tabulate", 2), ("tab1", 4), ("tab2", 4), 
+    ("tabstat", 7), ("describe", 1), ("codebook", 8), ("correlate", 3), 
+    ("pwcorr", 6), ("inspect", 2), ("count", 3), ("histogram", 4)
+)
+
+# Lines that are never cached: lines using macros, scalars, or earlier
+# r(), e(), or estimation results (which are not part of the cache key),
+# lines reading other files, and lines with options that change the 
+# data, write files, or create matrices (which replaying would skip).
+uncacheable = re.compile(
+    r"[`$]|\bscalar\(|\b[er]\(|\b_(b|se)\[|\busing\b|\breplace\b"
+    r"|\bgen[a-z]*\(|\bsav[a-z]*\(|\bmat[a-z]*\("
+)
+
+# markers written to the log by commands the cache sends to Stata
+DONE_MARKER = "NBCACHE_DONE|"
+SIG_MARKER = "NBCACHE_SIG|"
+
+# echoes of the commands the cache sends to Stata, which are not shown
+internal_echo = re.compile(
+    r'^\.\s+(capture (_return drop __nbc|quietly label dir|mata: __nbc'
+    r'|mata: mata drop __nbc|datasignature$|program list _nbc)'
+    r'|_return (hold|restore) __nbc|global NBC_|display "NBCACHE_'
+    r'|if _rc quietly run "|_nbc_rpost ")'
+)
+
+# datasignature does not cover storage types, formats, or labels, so 
+# they are hashed separately, and the hash is put in global NBC_LABELSIG
+label_hash_mata = (
+    'mata: __nbc_s = ""; '
+    'for (__nbc_i = 1; __nbc_i <= st_nvar(); __nbc_i++) '
+    '__nbc_s = __nbc_s + st_vartype(__nbc_i) + "|" + '
+    'st_varformat(__nbc_i) + "|" + '
+    'st_varlabel(__nbc_i) + "|" + st_varvaluelabel(__nbc_i) + "|"; '
+    '__nbc_n = tokens(st_global("r(names)")); __nbc_v = .; __nbc_t = ""; '
+    'for (__nbc_i = 1; __nbc_i <= cols(__nbc_n); __nbc_i++) { '
+    'st_vlload(__nbc_n[__nbc_i], __nbc_v, __nbc_t); '
+    '__nbc_s = __nbc_s + __nbc_n[__nbc_i] + ":" + '
+    'invtokens(strofreal(__nbc_v\')) + ":" + invtokens(__nbc_t\') + "|" }; '
+    'st_global("NBC_LABELSIG", strofreal(hash1(__nbc_s), "%12.0f"))'
+)
+
+# r() results of the previous cell are held while the signature 
+# is computed, and restored afterward
+signature_cmds = (
+    "capture _return drop __nbc_r",
+    "_return hold __nbc_r",
+    "global NBC_LABELSIG",
+    "capture quietly label dir",
+    "capture " + label_hash_mata,
+    "capture mata: mata drop __nbc_*",
+    "capture datasignature",
+    'display "' + SIG_MARKER + '" _rc "|`r(datasignature)\'|" ' + 
+        '`"`: data label\'"\' "|`: sortedby\'|`c(scheme)\'|`c(linesize)\'|' + 
+        '`c(version)\'|`c(dp)\'|$NBC_LABELSIG"',
+    "_return restore __nbc_r",
+)
+
+# r() scalars, macros, and matrices are written to a file with Mata's
+# fputmatrix(), in the order read back by rpost_mata
+rsave_mata = (
+    'mata: __nbc_t = ("numscalar", "macro", "matrix"); '
+    '__nbc_fh = fopen(st_global("NBC_RFILE"), "w"); '
+    'for (__nbc_k = 1; __nbc_k <= 3; __nbc_k++) { '
+    '__nbc_n = st_dir("r()", __nbc_t[__nbc_k], "*"); '
+    'fputmatrix(__nbc_fh, __nbc_n); '
+    'for (__nbc_i = 1; __nbc_i <= rows(__nbc_n); __nbc_i++) { '
+    '__nbc_r = "r(" + __nbc_n[__nbc_i] + ")"; '
+    'if (__nbc_k == 1) fputmatrix(__nbc_fh, st_numscalar(__nbc_r)); '
+    'else if (__nbc_k == 2) fputmatrix(__nbc_fh, st_global(__nbc_r)); '
+    'else { fputmatrix(__nbc_fh, st_matrix(__nbc_r)); '
+    'fputmatrix(__nbc_fh, st_matrixrowstripe(__nbc_r)); '
+    'fputmatrix(__nbc_fh, st_matrixcolstripe(__nbc_r)) } } }; '
+    'fclose(__nbc_fh)'
+)
+rpost_mata = (
+    'mata: __nbc_fh = fopen(st_local("path"), "r"); st_rclear(); '
+    'for (__nbc_k = 1; __nbc_k <= 3; __nbc_k++) { '
+    '__nbc_n = fgetmatrix(__nbc_fh); '
+    'for (__nbc_i = 1; __nbc_i <= rows(__nbc_n); __nbc_i++) { '
+    '__nbc_r = "r(" + __nbc_n[__nbc_i] + ")"; '
+    'if (__nbc_k == 1) st_numscalar(__nbc_r, fgetmatrix(__nbc_fh)); '
+    'else if (__nbc_k == 2) st_global(__nbc_r, fgetmatrix(__nbc_fh)); '
+    'else { st_matrix(__nbc_r, fgetmatrix(__nbc_fh)); '
+    'st_matrixrowstripe(__nbc_r, fgetmatrix(__nbc_fh)); '
+    'st_matrixcolstripe(__nbc_r, fgetmatrix(__nbc_fh)) } } }; '
+    'fclose(__nbc_fh)'
+)
+
+# Posting r() needs an r-class program, which is defined in a do-file
+# and (re)loaded whenever it is missing, e.g., after -clear all-
+rpost_program = """\
+program _nbc_rpost, rclass
+    args path
+    {}
+    capture mata: mata drop __nbc_*
+end
+""".format(rpost_mata)
+rpost_do = os.path.join(tempfile.gettempdir(), "nbcache_rpost.do")
+
+done_count = 0
+
+def normalize_cmd(cmd):
+    """remove blank lines, comment lines, and extra spaces"""
+    lines = (" ".join(line.split()) for line in cmd.splitlines())
+    return "\n".join(line for line in lines 
+                     if line and not line.startswith(("*", "//")))
+
+def matches_cmd(line, cmds):
+    cmd0 = re.split(r"[\s,]", line)[0]
+    return any(len(cmd0) >= n and name.startswith(cmd0) for name, n in cmds)
+
+def is_cacheable_cmd(cmd):
+    """check whether every line of cmd only describes or graphs data"""
+    lines = normalize_cmd(cmd).splitlines()
+    if not lines:
+        return False
+    for line in lines:
+        if uncacheable.search(line):
+            return False
+        if not (matches_cmd(line, replay_cmds) or 
+                matches_cmd(line, rclass_cmds)):
+            return False
+    return True
+
+def has_rclass_cmd(cmd):
+    return any(matches_cmd(line, rclass_cmds) 
+               for line in normalize_cmd(cmd).splitlines())
+
+def has_error(lines):
+    return any(line.startswith("r(") for line in lines)
+
+def stata_path(path):
+    """path with forward slashes, for use in Stata and Mata strings"""
+    return path.replace("\\", "/")
+
+def wait_for_stata():
+    """Wait until Stata has run every command sent so far, by sending a
+    marker and reading the log until the marker appears. Returns the 
+    log lines before the marker (without echoes of the cache's own 
+    commands), and whether the marker was found within 
+    CACHE_WAIT_SECONDS.
+    
+    """
+    global done_count
+    done_count += 1
+    marker = DONE_MARKER + str(done_count)
+    st_do("    display \"{}\"".format(marker))
+    
+    lines = []
+    partial = ""
+    in_echo = False
+    pre = time.time()
+    while (time.time() - pre) < CACHE_WAIT_SECONDS:
+        log_line = log_file.readline()
+        if not log_line:
+            time.sleep(0.125)
+            continue
+        partial += log_line
+        if not partial.endswith("\n"):
+            continue
+        log_line, partial = partial, ""
+        
+        if log_line.rstrip("\n") == marker:
+            return lines, True
+        # long echoes are continued on lines starting with "> "
+        if internal_echo.match(log_line):
+            in_echo = True
+        elif not (in_echo and log_line.startswith("> ")):
+            in_echo = False
+            if not log_line.startswith(DONE_MARKER):
+                lines.append(log_line)
+    
+    if partial:
+        lines.append(partial)
+    return lines, False
+
+def get_data_signature():
+    """return Stata's datasignature, along with a hash of storage types, 
+    formats, and labels and the settings that affect output, or None 
+    if they could not be obtained; output left over from earlier cells 
+    is printed
+    
+    """
+    for sig_cmd in signature_cmds:
+        st_do("    " + sig_cmd)
+    lines, done = wait_for_stata()
+    
+    signature = None
+    for line in lines:
+        if line.startswith(SIG_MARKER):
+            signature = line.strip()
+        else:
+            print(line, end="")
+    
+    # empty label hash means it could not be computed
+    if not done or signature is None or signature.endswith("|"):
+        return None
+    return signature
+    
+def save_rresults(r_path):
+    """send commands saving current r() to r_path, leaving r() as is"""
+    if os.path.exists(r_path):
+        os.remove(r_path)
+    for r_cmd in ("capture _return drop __nbc_s",
+                  "_return hold __nbc_s",
+                  "_return restore __nbc_s, hold",
+                  'global NBC_RFILE "{}"'.format(stata_path(r_path)),
+                  "capture " + rsave_mata,
+                  "capture mata: mata drop __nbc_*",
+                  "global NBC_RFILE",
+                  "_return restore __nbc_s"):
+        st_do("    " + r_cmd)
+    
+def post_rresults(r_path):
+    """post r() saved in r_path; return True if it succeeded"""
+    with open(rpost_do, "w") as f:
+        f.write(rpost_program)
+    st_do("    capture program list _nbc_rpost")
+    st_do('    if _rc quietly run "{}"'.format(stata_path(rpost_do)))
+    st_do('    _nbc_rpost "{}"'.format(stata_path(r_path)))
+    lines, done = wait_for_stata()
+    return done and not has_error(lines)
+    
+def cache_prefix(signature):
+    return hashlib.sha1(signature.encode("utf-8")).hexdigest()[:16]
+    
+def cache_paths(cmd, signature):
+    """return paths for cached text output, graph, and r() of cmd"""
+    key = hashlib.sha1(normalize_cmd(cmd).encode("utf-8")).hexdigest()[:16]
+    base = os.path.join(CACHE_LOCATION, cache_prefix(signature) + "_" + key)
+    return base + ".txt", base + ".png", base + ".rmat"
+    
+def cache_load(cmd, signature):
+    """return cached (text, graph path, r() path), or None if not 
+    cached; graph path and r() path are None if cmd has none
+    
+    """
+    txt_path, png_path, r_path = cache_paths(cmd, signature)
+    needs_r = has_rclass_cmd(cmd)
+    if not os.path.exists(txt_path) or (needs_r and 
+                                         not os.path.exists(r_path)):
+        return None
+    now = time.time()
+    os.utime(txt_path, (now, now))
+    with open(txt_path) as f:
+        text = f.read()
+    if needs_r:
+        os.utime(r_path, (now, now))
+    else:
+        r_path = None
+    if os.path.exists(png_path):
+        os.utime(png_path, (now, now))
+        return text, png_path, r_path
+    return text, None, r_path
+    
+def cache_store(cmd, signature, text, graph_file=None):
+    txt_path, png_path, r_path = cache_paths(cmd, signature)
+    if graph_file is not None:
+        shutil.copyfile(graph_file, png_path)
+    with open(txt_path, "w") as f:
+        f.write(text)
+    cache_evict()
+    
+def cache_evict():
+    """remove old cache files, then least recently used files 
+    until cache is within CACHE_MAX_MB
+    
+    """
+    now = time.time()
+    max_age = CACHE_MAX_AGE_DAYS * 24 * 60 * 60
+    max_bytes = CACHE_MAX_MB * 2**20
+    
+    entries = []
+    for f in os.listdir(CACHE_LOCATION):
+        path = os.path.join(CACHE_LOCATION, f)
+        mtime = os.path.getmtime(path)
+        if now - mtime > max_age:
+            os.remove(path)
+        else:
+            entries.append((mtime, os.path.getsize(path), path))
+    
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+    
+def do_cached(cmd):
+    """Replay cached output of cmd if data and settings are unchanged,
+    otherwise run cmd and cache its output. Returns (result, done),
+    where done is False if cmd still needs to be run.
+    
+    Cacheable cells do not change the data (see `uncacheable`), so
+    output is stored under the signature taken before the cell ran.
+    
+    """
+    signature = get_data_signature()
+    if signature is None:
+        return None, False
+    
+    cached = cache_load(cmd, signature)
+    if cached is not None:
+        text, graph_file, r_file = cached
+        # if r() cannot be restored, the cell is run as usual
+        if r_file is not None and not post_rresults(r_file):
+            return None, False
+        if graph_file is not None:
+            return Image(filename=graph_file), True
+        print(text, end="")
+        return None, True
+    
+    stataProg.UtilIsStataFreeEvent()
+    st_do("    " + cmd)
+    if has_rclass_cmd(cmd):
+        save_rresults(cache_paths(cmd, signature)[2])
+    lines, done = wait_for_stata()
+    text = "".join(lines)
+    error = has_error(lines)
+    
+    result = None
+    graph_file = None
+    if is_image_cmd(cmd) and done and not error:
+        result = get_graph()
+        if result is not None:
+            graph_file = os.path.join(GRAPH_LOCATION, "graph.png")
+    else:
+        print(text, end="")
+    
+    # If Stata has not finished, the rest of the output will show up
+    # in a later cell, as it does without caching.
+    if not done or error:
+        return result, True
+    if graph_file is not None:
+        cache_store(cmd, signature, "", graph_file)
+    elif not is_image_cmd(cmd):
+        cache_store(cmd, signature, text)
+    
+    return result, True
+
 @magics_class
 class MyMagics(Magics):
     @line_cell_magic
@@ -228,6 +599,10 @@ class MyMagics(Magics):
             suppress_output()
             return help_info
         else:
+            if CACHE_LOCATION is not None and is_cacheable_cmd(cmd):
+                result, done = do_cached(cmd)
+                if done:
+                    return result
             stataProg.UtilIsStataFreeEvent()
             rc = st_do("    " + cmd)
             if is_image_cmd(cmd):
@@ -0,0 +1,241 @@
+import os
+import json
+import threading
+import urllib.error
+import urllib.request
+from functools import partial
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import dta_server
+from dta_server import (DtaWindow, DtaRequestHandler, LRUCache, MAX_WINDOW,
+                        STRL_INLINE_LEN, media_type, missing_str, thumb_size)
+
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\0' * 20
+LONG_TEXT = b'x' * (STRL_INLINE_LEN + 1)
+
+VARLIST = ["b", "i", "l", "f", "d", "s", "note"]
+TYPLIST = [65530, 65529, 65528, 65527, 65526, 4, 32768]
+ROWS = [
+    [1, -2, 3, 1.5, -2.5, "ab", (1, 1)],
+    ['.', '.', '.', '.', '.', "", (0, 0)],
+    ['.a', '.b', '.c', '.d', '.e', "abcd", (7, 3)],
+    ['.z', '.z', '.z', '.z', '.z', "z", (7, 4)],
+    [100, 32740, 2147483620, -3.0, 1e300, "q", (1, 1)],
+]
+STRLS = [
+    (1, 1, b'short note', False),
+    (7, 3, PNG, True),
+    (7, 4, LONG_TEXT, False),
+]
+
+
+@pytest.fixture(params=['<', '>'])
+def window(request, make_dta):
+    address = make_dta(varlist=VARLIST, typlist=TYPLIST, rows=ROWS,
+                       chrdict={"d": {"_units": "km"}}, strls=STRLS,
+                       byteorder=request.param, data_label="birds")
+    window = DtaWindow(address)
+    yield window
+    window.close()
+
+
+def test_metadata(window):
+    meta = window.metadata()
+    assert meta['nobs'] == len(ROWS)
+    assert meta['nvar'] == len(VARLIST)
+    assert meta['data_label'] == "birds"
+    assert meta['varlist'] == VARLIST
+    assert meta['typlist'] == TYPLIST
+    assert meta['fmtlist'] == ["%9.0g"] * len(VARLIST)
+    assert meta['vlblist'] == ["label " + v for v in VARLIST]
+    assert meta['chrdict'] == {"d": {"_units": "km"}}
+
+
+def test_rows_decode_values_and_missing_values(window):
+    start, stop, rows = window.rows(0, 100)
+    assert (start, stop) == (0, len(ROWS))
+    assert [row[:6] for row in rows] == [
+        [1, -2, 3, 1.5, -2.5, "ab"],
+        ['.', '.', '.', '.', '.', ""],
+        ['.a', '.b', '.c', '.d', '.e', "abcd"],
+        ['.z', '.z', '.z', '.z', '.z', "z"],
+        [100, 32740, 2147483620, -3.0, 1e300, "q"],
+    ]
+
+
+def test_rows_strls(window):
+    notes = [row[6] for row in window.rows(0, len(ROWS))[2]]
+    assert notes == [
+        "short note",
+        "",
+        {'strl': [7, 3], 'binary': True},
+        {'strl': [7, 4], 'binary': False},  # too long to send inline
+        "short note",
+    ]
+
+
+def test_row_windows(window):
+    assert window.rows(2, 4)[2] == window.rows(0, 5)[2][2:4]
+    assert window.rows(-3, 1)[:2] == (0, 1)
+    assert window.rows(4, 2)[:2] == (4, 4)
+    start, stop, raw = window.raw_rows(1, 3)
+    assert (start, stop) == (1, 3)
+    assert len(raw) == 2 * (1 + 2 + 4 + 4 + 8 + 4 + 8)
+    assert window._check_window(0, 10 * MAX_WINDOW) == (0, len(ROWS))
+    window._nobs = 10 * MAX_WINDOW
+    assert window._check_window(5, 10 * MAX_WINDOW) == (5, 5 + MAX_WINDOW)
+
+
+def test_strl_index(window):
+    assert set(window._strl_index) == {(1, 1), (7, 3), (7, 4)}
+    assert window.strl(1, 1) == (b'short note', False)
+    assert window.strl(7, 3) == (PNG, True)
+    assert window.strl(7, 4) == (LONG_TEXT, False)
+    # second read comes from the cache
+    assert window._strl_cache.get((7, 3)) == PNG
+    with pytest.raises(ValueError):
+        window.strl(1, 2)
+
+
+def test_malformed_strls(make_dta):
+    address = make_dta(varlist=["note"], typlist=[32768], rows=[[(1, 1)]],
+                       strls=[(1, 1, b'text', False)])
+    with open(address, 'r+b') as f:
+        contents = f.read()
+        f.seek(contents.index(b'GSO'))
+        f.write(b'GS0')
+    with pytest.raises(ValueError):
+        DtaWindow(address)
+
+
+def test_thumbnail_without_image(window, tmp_path):
+    thumb_dir = tmp_path / "thumbs"
+    thumb_dir.mkdir()
+    contents, mtype = window.thumbnail(1, 1, 100, str(thumb_dir))
+    assert (contents, mtype) == (b'short note', "application/octet-stream")
+    # not a valid image, with or without Pillow
+    assert window.thumbnail(7, 3, 100, str(thumb_dir)) == (PNG, "image/png")
+    assert os.listdir(str(thumb_dir)) == []
+
+
+def test_not_117(tmp_path):
+    address = str(tmp_path / "old.dta")
+    with open(address, 'wb') as f:
+        f.write(b'\x73\x02\x01\x00' + b'\0' * 200)
+    with pytest.raises(ValueError):
+        DtaWindow(address)
+
+
+def test_helpers():
+    assert missing_str(0) == '.'
+    assert missing_str(1) == '.a'
+    assert missing_str(26) == '.z'
+    assert media_type(PNG) == "image/png"
+    assert media_type(b'RIFF....WAVE') == "audio/wav"
+    assert media_type(b'plain') == "application/octet-stream"
+    assert [thumb_size(s) for s in (-5, 1, 50, 51, 100, 399, 400, 10**9)] == [
+        50, 50, 50, 100, 100, 400, 400, 400]
+
+
+def test_lru_cache():
+    cache = LRUCache(10)
+    cache.put('a', b'1234')
+    cache.put('b', b'1234')
+    assert cache.get('a') == b'1234'  # now most recently used
+    cache.put('c', b'1234')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234'
+    cache.put('d', b'x' * 11)  # larger than the whole cache
+    assert cache.get('d') is None
+    assert cache.get('c') == b'1234'
+
+
+@pytest.fixture
+def handler(tmp_path, monkeypatch):
+    """request handler with no connection, for calling translate_path"""
+    slickgrid = tmp_path / "SlickGrid"
+    (slickgrid / "lib").mkdir(parents=True)
+    (slickgrid / "slick.grid.js").write_text("grid")
+    (slickgrid / "lib" / "jquery.js").write_text("jquery")
+    (tmp_path / "secret.txt").write_text("secret")
+    os.symlink(str(tmp_path / "secret.txt"), str(slickgrid / "link.txt"))
+    monkeypatch.setattr(dta_server, "SLICKGRID_DIR", str(slickgrid))
+    handler = DtaRequestHandler.__new__(DtaRequestHandler)
+    handler.directory = str(slickgrid)
+    return handler
+
+
+def test_translate_path_allows_page_files(handler):
+    here = dta_server.HERE
+    assert handler.translate_path("/read_dta.html") == os.path.join(
+        here, "read_dta.html")
+    assert handler.translate_path("/StataDta.js?x=1") == os.path.join(
+        here, "StataDta.js")
+    grid_js = handler.translate_path("/SlickGrid/slick.grid.js")
+    assert open(grid_js).read() == "grid"
+    assert open(handler.translate_path("/SlickGrid/lib/jquery.js")).read() == (
+        "jquery")
+
+
+@pytest.mark.parametrize("path", [
+    "/", "/dta_server.py", "/benchmark.py", "/../read_dta.html",
+    "/SlickGrid", "/SlickGrid/", "/SlickGrid/lib",
+    "/SlickGrid/../secret.txt", "/SlickGrid/..%2Fsecret.txt",
+    "/SlickGrid/link.txt", "/SlickGrid/../../../etc/passwd",
+    "//etc/passwd", "/SlickGrid//etc/passwd",
+])
+def test_translate_path_refuses_other_paths(handler, path):
+    assert not os.path.exists(handler.translate_path(path))
+
+
+@pytest.fixture
+def server(window, tmp_path, monkeypatch):
+    monkeypatch.setattr(DtaRequestHandler, "window", window)
+    monkeypatch.setattr(DtaRequestHandler, "thumb_dir", str(tmp_path))
+    monkeypatch.setattr(DtaRequestHandler, "log_message",
+                        lambda self, *args: None)
+    handler = partial(DtaRequestHandler, directory=str(tmp_path))
+    server = ThreadingHTTPServer(("localhost", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,),
+                              daemon=True)
+    thread.start()
+    yield "http://localhost:{}".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def get(url):
+    with urllib.request.urlopen(url) as response:
+        return response.read(), dict(response.headers)
+
+
+def test_server_endpoints(server, window):
+    meta, headers = get(server + "/meta")
+    assert json.loads(meta.decode())['varlist'] == VARLIST
+    assert "Access-Control-Allow-Origin" not in headers
+
+    body, headers = get(server + "/rows?start=1&stop=3")
+    assert json.loads(body.decode()) == {
+        'start': 1, 'stop': 3, 'rows': json.loads(json.dumps(window.rows(1, 3)[2]))}
+
+    body, headers = get(server + "/rows?start=1&stop=3&format=bin")
+    assert body == window.raw_rows(1, 3)[2]
+    assert (headers["X-Dta-Start"], headers["X-Dta-Stop"]) == ("1", "3")
+
+    body, headers = get(server + "/strl?v=7&o=3")
+    assert (body, headers["Content-Type"]) == (PNG, "image/png")
+    body, headers = get(server + "/thumb?v=7&o=3&size=100000")
+    assert (body, headers["Content-Type"]) == (PNG, "image/png")
+
+
+@pytest.mark.parametrize("path, status", [
+    ("/", 404), ("/dta_server.py", 404), ("/strl?v=1&o=2", 400),
+    ("/strl?v=1", 400), ("/rows?start=x", 400),
+])
+def test_server_errors(server, path, status):
+    with pytest.raises(urllib.error.HTTPError) as error:
+        get(server + path)
+    assert error.value.code == status
@@ -0,0 +1,178 @@
+import os
+import stat
+
+import pytest
+
+from conftest import pack_value
+from incremental_dta import IncrementalSave, _FullRewrite
+
+
+VARLIST = ["b", "i", "l", "f", "d", "s"]
+TYPLIST = [65530, 65529, 65528, 65527, 65526, 5]
+ROWS = [
+    [1, 2, 3, 1.5, 2.5, "ab"],
+    [-1, -2, -3, -1.5, -2.5, "cd"],
+    ['.', '.a', '.z', '.', '.b', ""],
+]
+ROWLEN = 1 + 2 + 4 + 4 + 8 + 5
+
+
+class SavedDta():
+    """the parts of Dta117 that IncrementalSave relies on; full saves
+    are only recorded
+
+    """
+    def __init__(self, address, rows, chrdict):
+        self._fullpath = address
+        self._varlist = list(VARLIST)
+        self._varvals = [list(row) for row in rows]
+        self._chrdict = chrdict
+        self._changed = False
+        self.full_saves = []
+
+    def save(self, address=None, replace=False):
+        self.full_saves.append(address)
+
+
+class TrackedDta(IncrementalSave, SavedDta):
+    pass
+
+
+@pytest.fixture
+def dta(make_dta):
+    chrdict = {"d": {"_units": "km"}}
+    address = make_dta(varlist=VARLIST, typlist=TYPLIST, rows=ROWS,
+                       chrdict=chrdict)
+    os.chmod(address, 0o644)
+    return TrackedDta(address, ROWS, chrdict)
+
+
+def read_file(dta):
+    """return map offsets, raw data rows, and characteristics section"""
+    with open(dta._fullpath, 'rb') as dta_file:
+        offsets = dta._read_dta117_layout(dta_file)[2]
+        dta_file.seek(offsets[9] + 6)
+        raw = dta_file.read(offsets[10] - offsets[9] - 13)
+        dta_file.seek(offsets[8])
+        chrs = dta_file.read(offsets[9] - offsets[8])
+    rows = [raw[i:i + ROWLEN] for i in range(0, len(raw), ROWLEN)]
+    return offsets, rows, chrs
+
+
+@pytest.mark.parametrize("typ", [65530, 65529, 65528, 65527, 65526])
+@pytest.mark.parametrize("mv", ['.', '.a', '.m', '.z'])
+def test_pack_missing_values(dta, typ, mv):
+    for bo in '<>':
+        assert dta._pack_col_value(mv, typ, bo) == pack_value(mv, typ, bo)
+    assert dta._pack_col_value(None, typ, '<') == pack_value('.', typ, '<')
+
+
+@pytest.mark.parametrize("value, typ", [
+    (101, 65530), (-128, 65530), (32741, 65529), (2147483621, 65528),
+    (1.5, 65530), (1e39, 65527), (1e308, 65526),
+    (float('nan'), 65526), (float('inf'), 65527), (float('-inf'), 65528),
+    ("abcdef", 5), (3, 5), ("x", 32768), (".ab", 65526),
+])
+def test_pack_values_that_do_not_fit(dta, value, typ):
+    with pytest.raises(_FullRewrite):
+        dta._pack_col_value(value, typ, '<')
+
+
+def test_convert_saves_column_in_place(dta):
+    for row in dta._varvals:
+        if not isinstance(row[4], str):
+            row[4] *= 1000
+    dta._mark_dirty("d", data=True)
+    before = os.path.getsize(dta._fullpath)
+    dta.save()
+
+    assert dta.full_saves == []
+    assert not dta.changed
+    assert os.path.getsize(dta._fullpath) == before
+    rows = read_file(dta)[1]
+    assert [row[11:19] for row in rows] == [
+        pack_value(2500.0, 65526, '<'), pack_value(-2500.0, 65526, '<'),
+        pack_value('.b', 65526, '<')]
+    # other columns are untouched
+    assert [row[:11] + row[19:] for row in rows] == [
+        b''.join(pack_value(v, t, '<') for v, t in zip(r, TYPLIST)
+                 if t != 65526)
+        for r in ROWS]
+
+
+@pytest.mark.parametrize("value", [200, float('nan'), float('inf')])
+def test_value_that_does_not_fit_falls_back(dta, value):
+    with open(dta._fullpath, 'rb') as f:
+        original = f.read()
+    dta._varvals[1][0] = value
+    dta._mark_dirty("b", data=True)
+    dta.save()
+    assert dta.full_saves == [None]
+    with open(dta._fullpath, 'rb') as f:
+        assert f.read() == original
+
+
+@pytest.mark.parametrize("units", ["kilometer", "m", "mi"])
+def test_resized_characteristics(dta, units):
+    old_offsets, old_rows, old_chrs = read_file(dta)
+    dta._chrdict["d"]["_units"] = units
+    dta._chrdict["f"] = {"_units": "lb"}
+    dta._mark_dirty("d")
+    dta._mark_dirty("f")
+    dta.save()
+
+    assert dta.full_saves == []
+    offsets, rows, chrs = read_file(dta)
+    delta = len(chrs) - len(old_chrs)
+    # new entry for f: '<ch>', length, names, 'lb\0', '</ch>'
+    assert delta == len(units) - 2 + 4 + 4 + 66 + 3 + 5
+    assert offsets[:9] == old_offsets[:9]
+    assert offsets[9:] == [o + delta for o in old_offsets[9:]]
+    assert offsets[13] == os.path.getsize(dta._fullpath)
+    assert rows == old_rows
+    assert chrs == dta._chrs_to_bytes('<')
+    assert stat.S_IMODE(os.stat(dta._fullpath).st_mode) == 0o644
+
+
+def test_same_size_characteristics_patched_in_place(dta):
+    old_offsets, old_rows, old_chrs = read_file(dta)
+    dta._chrdict["d"]["_units"] = "mi"
+    dta._mark_dirty("d")
+    dta.save()
+    offsets, rows, chrs = read_file(dta)
+    assert (offsets, rows) == (old_offsets, old_rows)
+    assert chrs == old_chrs.replace(b'km\0', b'mi\0')
+
+
+@pytest.mark.parametrize("edit_first", [True, False])
+def test_direct_changed_forces_full_rewrite(dta, edit_first):
+    # Dta117 methods record their changes as `self._changed = True`
+    if edit_first:
+        dta._varvals[0][3] = 7.0
+        dta._changed = True
+        dta._mark_dirty("d")
+    else:
+        dta._mark_dirty("d")
+        dta._varvals[0][3] = 7.0
+        dta._changed = True
+    dta.save()
+    assert dta.full_saves == [None]
+    assert not dta._changed
+
+
+def test_save_elsewhere_is_full_rewrite(dta, tmp_path):
+    dta._mark_dirty("d")
+    dta.save(str(tmp_path / "other.dta"))
+    assert dta.full_saves == [str(tmp_path / "other.dta")]
+    dta._mark_dirty("d")
+    dta.save(dta._fullpath, replace=True)
+    assert dta.full_saves == [str(tmp_path / "other.dta")]
+
+
+def test_malformed_file_falls_back(dta):
+    with open(dta._fullpath, 'r+b') as f:
+        f.seek(read_file(dta)[0][9])
+        f.write(b'<dat@>')
+    dta._mark_dirty("d")
+    dta.save()
+    assert dta.full_saves == [None]
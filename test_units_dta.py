@@ -0,0 +1,69 @@
+import os
+import stat
+
+import pytest
+
+pytest.importorskip("sympy")
+pytest.importorskip("stata_dta")
+
+from stata_dta import Dta117
+from units_dta import UDta
+
+
+@pytest.fixture
+def dta_path(make_dta):
+    rows = [[1.5 * i, i, i % 100, '.a' if i % 7 == 0 else 2.0 * i, i]
+            for i in range(50)]
+    path = make_dta("units.dta",
+                    varlist=["x0", "x1", "x2", "x3", "x4"],
+                    typlist=[65526, 65528, 65530, 65526, 65529],
+                    rows=rows,
+                    chrdict={"x0": {"_units": "mi"}, "x2": {"_units": "m"}})
+    os.chmod(path, 0o644)
+    return path
+
+
+@pytest.fixture
+def full_saves(monkeypatch):
+    """record calls of Dta117.save, i.e., full rewrites"""
+    calls = []
+    orig_save = Dta117.save
+    def save(self, *args, **kwargs):
+        calls.append(args)
+        return orig_save(self, *args, **kwargs)
+    monkeypatch.setattr(Dta117, "save", save)
+    return calls
+
+
+def test_units_set_saves_incrementally(dta_path, full_saves):
+    dta = UDta(dta_path)
+    dta.units_set("x1", "kilometer", replace=True)
+    dta.save()
+    assert full_saves == []
+    assert UDta(dta_path)._chrdict["x1"]["_units"] == "kilometer"
+    assert stat.S_IMODE(os.stat(dta_path).st_mode) == 0o644
+
+
+def test_units_convert_saves_incrementally(dta_path, full_saves):
+    dta = UDta(dta_path)
+    dta.units_convert("x0", "km")
+    expected = [row[0] for row in dta._varvals]
+    dta.save()
+    assert full_saves == []
+    assert [row[0] for row in UDta(dta_path)._varvals] == expected
+
+
+@pytest.mark.parametrize("edit_first", [True, False])
+def test_untracked_edit_forces_full_rewrite(dta_path, full_saves, edit_first):
+    dta = UDta(dta_path)
+    if edit_first:
+        dta[0, "x1"] = 42
+        dta.units_set("x2", "kilometer", replace=True)
+    else:
+        dta.units_set("x2", "kilometer", replace=True)
+        dta[0, "x1"] = 42
+    dta.save(replace=True)
+    assert len(full_saves) == 1
+    reopened = UDta(dta_path)
+    assert reopened._varvals[0][1] == 42
+    assert reopened._chrdict["x2"]["_units"] == "kilometer"
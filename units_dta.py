@@ -7,6 +7,7 @@ from sympy.physics.units import Unit
 from sympy.core.numbers import Number as sympyNumber
 
 from stata_dta import Dta117
+from incremental_dta import IncrementalSave
 try:
     from stata import st_format
     IN_STATA = True
@@ -142,7 +143,7 @@ units.M = units.million = units.millions = 10**6
 units.B = units.billion = units.billions = 10**9
 
 
-class UDta(Dta117):
+class UDta(IncrementalSave, Dta117):
 
     def _get_unit(self, unit_repr):
         unit_repr = unit_repr.replace("^", "**")
@@ -200,7 +201,7 @@ class UDta(Dta117):
         # set unit 
         varDict["_units"] = unit_repr
         
-        self.changed = True
+        self._mark_dirty(varname)
         
     unit_set = units_set
         
@@ -243,7 +244,7 @@ class UDta(Dta117):
         # set unit 
         varDict["_units"] = unit_repr
         
-        self.changed = True
+        self._mark_dirty(varname, data=True)
         
     unit_convert = units_convert
         